@@ -16,8 +16,12 @@ def _get_account_number():
     if dep_target is None:
         raise Exception('Deployment is only supported when the build is deployment source')
     else:
-        varname = 'account_number_{}'.format(dep_target).upper()
-        return getenv(varname)
+        return _get_env_account_number(dep_target)
+
+
+def _get_env_account_number(env):
+    varname = 'account_number_{}'.format(env).upper()
+    return getenv(varname)
 
 
 def _get_self_region():
@@ -115,9 +119,62 @@ def _build_promote_config():
     }
 
 
+def _getenv_lazy(name, default):
+    value = getenv(name)
+    return value if value is not None else default()
+
+
+def _build_plan_many_config():
+    envs = getenv('target_envs', getenv('DRONE_DEPLOY_TO'))
+    if envs is None:
+        raise Exception('Required parameter target_envs is not set')
+
+    envs = envs.split(',')
+    accounts = dict()
+    for env in envs:
+        accounts[env] = _get_env_account_number(env)
+        if accounts[env] is None:
+            raise Exception('No account number is set for environment {}'.format(env))
+
+    for each in ['target_task', 'PLUGIN_LAMBDA_FUNC', 'PLUGIN_DYNAMODB_TABLE', 'DRONE_COMMIT', 'DRONE_BUILD_NUMBER']:
+        if getenv(each) is None:
+            raise Exception('Required parameter {} is not set'.format(each))
+
+    concurrency = getenv('plan_concurrency')
+
+    return {
+        'target_envs': envs,
+        'target_jobs': getenv('target_jobs', getenv('target_job', 'jobspec')).split(','),
+        'target_task': getenv('target_task'),
+        'container_tag': _getenv_lazy('container_tag', _get_tag),
+        'lambda_func': getenv('PLUGIN_LAMBDA_FUNC'),
+        'dynamodb_table': getenv('PLUGIN_DYNAMODB_TABLE'),
+        'accounts': accounts,
+        'local_account': _getenv_lazy('local_account', _get_local_account_number),
+        'region': _getenv_lazy('PLUGIN_REGION', _get_self_region),
+        'ci_role': getenv('PLUGIN_CI_ROLE', 'ci'),
+        'dc': _get_datacenters(),
+        'commit_id': getenv('DRONE_COMMIT'),
+        'build_number': getenv('DRONE_BUILD_NUMBER'),
+        'plan_concurrency': int(concurrency) if concurrency is not None else None,
+        'plan_batch_size': int(getenv('plan_batch_size', '25')),
+        'verbose': _is_debug()
+    }
+
+
+def _build_rollout_config():
+    config = _build_create_config()
+    config['target_jobs'] = getenv('target_jobs', config.pop('target_job')).split(',')
+    config['manifest'] = getenv('rollout_manifest')
+    del config['only_plan']
+    return config
+
+
 _builder = {
     'create': _build_create_config,
-    'promote': _build_promote_config
+    'promote': _build_promote_config,
+    'plan_many': _build_plan_many_config,
+    'rollout': _build_rollout_config
 }
 
 
@@ -1,6 +1,7 @@
 import requests
 import boto3
 import random
+from concurrent.futures import ThreadPoolExecutor
 from os import getenv
 
 in_local_mode = True if getenv('LOCAL_MODE') == 'true' else False
@@ -10,6 +11,8 @@ nomad_tag_value = getenv('NOMAD_TAG_VALUE', 'nomad-server')
 consul_server_tag = getenv('CONSUL_TAG_NAME', 'role')
 consul_tag_value = getenv('CONSUL_TAG_VALUE', 'consul-server')
 
+plan_concurrency = int(getenv('PLAN_CONCURRENCY', '8'))
+
 
 def _get_random_server(tag_name, tag_value):
     ec2_client = boto3.client('ec2')
@@ -60,10 +63,31 @@ def _make_request(method, uri, as_json, **kwargs):
     return response.json() if as_json else response.text
 
 
+def _plan_request(spec, base_url):
+    return _make_request('post', '{}/job/{}/plan'.format(base_url, spec.get('ID')), as_json=True,
+                         json=dict(Job=spec, Diff=True))
+
+
 def _plan(event):
-    job_id = event.get('spec').get('ID')
-    return _make_request('post', _nomad_url('/job/{}/plan'.format(job_id)), as_json=True,
-                         json=dict(Job=event.get('spec'), Diff=True))
+    return _plan_request(event.get('spec'), _nomad_url(''))
+
+
+def _plan_many(event):
+    specs = event.get('specs') or []
+    limit = event.get('concurrency') or plan_concurrency
+    workers = max(1, min(int(limit), len(specs)))
+
+    # Resolve the server once, every plan in the batch goes to the same Nomad server
+    base_url = _nomad_url('')
+
+    def _safe_plan(spec):
+        try:
+            return dict(ID=spec.get('ID'), result=_plan_request(spec, base_url))
+        except Exception as e:
+            return dict(ID=spec.get('ID'), error=str(e))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_safe_plan, specs))
 
 
 def _run(event):
@@ -75,6 +99,11 @@ def _get_evaluation(event):
     return _make_request('get', _nomad_url('/evaluation/{}'.format(event.get('evaluation_id'))), as_json=True)
 
 
+def _get_evaluation_allocations(event):
+    return _make_request('get', _nomad_url('/evaluation/{}/allocations'.format(event.get('evaluation_id'))),
+                         as_json=True)
+
+
 def _get_deployment(event):
     return _make_request('get', _nomad_url('/deployment/{}'.format(event.get('deployment_id'))), as_json=True)
 
@@ -97,8 +126,10 @@ def _put_kv(event):
 
 _actions = {
     'plan': _plan,
+    'plan_many': _plan_many,
     'run': _run,
     'get_eval': _get_evaluation,
+    'get_eval_allocations': _get_evaluation_allocations,
     'get_deployment': _get_deployment,
     'promote': _promote,
     'put_kv': _put_kv,
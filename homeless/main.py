@@ -1,13 +1,28 @@
 import boto3
+import copy
 import time
 import json
 import subprocess
 from os import path, getenv
 import decimal
 from .config import build_config, NOMAD_BIN_PATH
+from .session import open_session
 
 in_local_mode = True if getenv('LOCAL_MODE') == 'true' else False
+record_session = getenv('RECORD_SESSION')
+replay_session = getenv('REPLAY_SESSION')
+profile_output = getenv('PROFILE_OUTPUT')
+profile_hook = getenv('PROFILE_HOOK')
 logger = None
+session = None
+
+
+def _recorded(kind, fn):
+    return session.wrap(kind, fn) if session is not None else fn
+
+
+def _replaying():
+    return session is not None and session.replaying
 
 
 def _get_client(service, role, region, session_name, resource=None):
@@ -22,7 +37,7 @@ def _get_client(service, role, region, session_name, resource=None):
                 region_name=region)
 
 
-def _load_job_spec(job):
+def _render_job_spec(job):
     subp = subprocess.Popen([NOMAD_BIN_PATH, 'run', '--output', job + '.nomad'],
                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
@@ -33,6 +48,18 @@ def _load_job_spec(job):
     return json.loads(stdout)
 
 
+def _load_job_spec(job):
+    return _recorded('jobspec', _render_job_spec)(job=job)
+
+
+def _ensure_job_file(target_job):
+    if _replaying():
+        return
+
+    if not path.exists('{}.nomad'.format(target_job)):
+        raise Exception('Unknown target job {}. Expecting file "{}.nomad" to exist'.format(target_job, target_job))
+
+
 def _match_cond(cond, data):
     matcher = cond.replace('@cond(', '').rstrip(')').split(' ')
     if len(matcher) != 3:
@@ -208,24 +235,51 @@ def _print_plan(plan):
                                                                 ann), flush=True)
 
 
-def _plan_deployment(client, spec):
-    diff = client(spec=spec['Job'], action='plan')
+def _placement_failures(diff):
     failures = diff.get('FailedTGAllocs') or dict()
     if failures.keys():
         print('Failed to place allocations: ' + json.dumps(failures, indent=2), flush=True)
+        return True
+
+    return False
+
+
+def _plan_deployment(client, spec):
+    diff = client(spec=spec['Job'], action='plan')
+    if _placement_failures(diff):
         raise Exception('Task plan failed')
 
     _print_plan(diff)
     return diff.get('JobModifyIndex')
 
 
-def _queue_job(client, spec, modification_index):
+def _report_batch_plan(batch, results):
+    report = []
+    for (env, job, _), result in zip(batch, results):
+        print('==> Environment "{}", job "{}"'.format(env, job), flush=True)
+        if 'error' in result:
+            print('Plan request failed: {}'.format(result.get('error')), flush=True)
+            report.append((env, job, 'error'))
+        elif _placement_failures(result.get('result')):
+            report.append((env, job, 'placement failed'))
+        else:
+            _print_plan(result.get('result'))
+            report.append((env, job, 'ok'))
+
+    return report
+
+
+def _queue_evaluation(client, spec, modification_index):
     result = client(spec=spec, action='run', index=modification_index)
     if result.get('EvalID') == "":
         return None
 
-    evaluation = client(action='get_eval', evaluation_id=result.get('EvalID'))
-    return evaluation.get('DeploymentID')
+    return client(action='get_eval', evaluation_id=result.get('EvalID'))
+
+
+def _queue_job(client, spec, modification_index):
+    evaluation = _queue_evaluation(client, spec, modification_index)
+    return evaluation.get('DeploymentID') if evaluation is not None else None
 
 
 def _ready_to_promote(deployment):
@@ -305,10 +359,12 @@ def _get_lambda_client(func, iam_role_arn, region, session_name):
 
         return _client_wrapper
 
-    if in_local_mode:
-        return _sync_client
+    if _replaying():
+        return _recorded('lambda', None)
+    elif in_local_mode:
+        return _recorded('lambda', _sync_client)
     else:
-        return _lambda(_get_client('lambda', iam_role_arn, region, session_name))
+        return _recorded('lambda', _lambda(_get_client('lambda', iam_role_arn, region, session_name)))
 
 
 def _get_dynamodb_table(table_name, iam_role, region, session_prefix):
@@ -326,11 +382,17 @@ def _get_dynamodb_table(table_name, iam_role, region, session_prefix):
             with open(patch_file) as f:
                 return dict(Item=json.load(f))
 
-    if in_local_mode:
-        return DumbTable(table_name)
+    class RecordedTable(object):
+        def __init__(self, table):
+            self.get_item = _recorded('dynamodb', table.get_item if table is not None else None)
+
+    if _replaying():
+        return RecordedTable(None)
+    elif in_local_mode:
+        return RecordedTable(DumbTable(table_name))
     else:
         client = _get_client('dynamodb', iam_role, region, session_prefix, resource=True)
-        return client.Table(table_name)
+        return RecordedTable(client.Table(table_name))
 
 
 def _get_promotion_cb(client, spec, task_name, tag):
@@ -354,7 +416,7 @@ def _get_promotion_cb(client, spec, task_name, tag):
 def _on_placements_ready(client, deployment_id, cb):
     while not _allocations_placed(client, deployment_id):
         print('Deployment is still running, waiting for allocations to be placed...', flush=True)
-        time.sleep(10)
+        time.sleep(0 if _replaying() else 10)
         continue
 
     return cb()
@@ -364,8 +426,7 @@ def place_allocations(target_env, target_job, target_task, container_tag, lambda
                       commit_id, build_number, account_number, local_account, region, ci_role, dc, only_plan):
     session_name_prefix = 'drone-{}-{}'.format(commit_id[:8], build_number)
 
-    if not path.exists('{}.nomad'.format(target_job)):
-        raise Exception('Unknown target job {}. Expecting file "{}.nomad" to exist'.format(target_job, target_job))
+    _ensure_job_file(target_job)
 
     local_arn = 'arn:aws:iam::{}:role/{}'.format(local_account, ci_role)
     target_arn = 'arn:aws:iam::{}:role/{}'.format(account_number, ci_role)
@@ -395,6 +456,251 @@ def place_allocations(target_env, target_job, target_task, container_tag, lambda
             print('Deployment successful', flush=True)
 
 
+# Synchronous lambda invocations are limited to 6MB of request and of response payload,
+# plan diffs are usually larger than the specs so chunks are kept well below that
+_plan_chunk_bytes = 2 * 1024 * 1024
+
+
+def _plan_chunks(batch, chunk_size):
+    chunk, chunk_bytes = [], 0
+    for entry in batch:
+        spec_bytes = len(json.dumps(entry[2].get('Job')))
+        if chunk and (len(chunk) >= chunk_size or chunk_bytes + spec_bytes > _plan_chunk_bytes):
+            yield chunk
+            chunk, chunk_bytes = [], 0
+
+        chunk.append(entry)
+        chunk_bytes += spec_bytes
+
+    if chunk:
+        yield chunk
+
+
+def plan_many(target_envs, target_jobs, target_task, container_tag, lambda_func, dynamodb_table, accounts,
+              local_account, region, ci_role, dc, commit_id, build_number, plan_concurrency, plan_batch_size):
+    session_name_prefix = 'drone-{}-{}'.format(commit_id[:8], build_number)
+
+    for target_job in target_jobs:
+        _ensure_job_file(target_job)
+
+    local_arn = 'arn:aws:iam::{}:role/{}'.format(local_account, ci_role)
+    dynamodb_table = _get_dynamodb_table(dynamodb_table, local_arn, region, session_name_prefix)
+
+    base_specs = {job: _load_job_spec(job) for job in target_jobs}
+
+    # Environments sharing an account are planned by the same lambda, a chunk of jobs per call
+    batches = dict()
+    for env in target_envs:
+        for job in target_jobs:
+            spec = _process_job_overrides(dynamo=dynamodb_table,
+                                          base_spec=copy.deepcopy(base_specs[job]),
+                                          env=env,
+                                          tag=container_tag,
+                                          task=target_task,
+                                          dc=dc)
+            batches.setdefault(accounts[env], []).append((env, job, spec))
+
+    report = []
+    for account_number, batch in batches.items():
+        target_arn = 'arn:aws:iam::{}:role/{}'.format(account_number, ci_role)
+        lambda_client = _get_lambda_client(lambda_func, target_arn, region, session_name_prefix)
+        for chunk in _plan_chunks(batch, plan_batch_size):
+            results = lambda_client(action='plan_many',
+                                    specs=[spec.get('Job') for _, _, spec in chunk],
+                                    concurrency=plan_concurrency)
+            report.extend(_report_batch_plan(chunk, results))
+
+    print('Plan summary:', flush=True)
+    for env, job, status in report:
+        print('  {} / {}: {}'.format(env, job, status), flush=True)
+
+    if any(status != 'ok' for _, _, status in report):
+        raise Exception('Task plan failed')
+
+
+def _read_manifest(manifest):
+    with open(manifest) as f:
+        return json.load(f)
+
+
+def _rollout_dependencies(specs, manifest):
+    declared = _recorded('manifest', _read_manifest)(manifest=manifest) if manifest is not None else dict()
+    if not isinstance(declared, dict):
+        raise Exception('Rollout manifest must map job IDs to lists of job IDs they depend on')
+
+    unknown = set(declared.keys()) - specs.keys()
+    if unknown:
+        raise Exception('Rollout manifest declares dependencies of jobs {} which are not part of the rollout'.format(
+            sorted(unknown)))
+
+    graph = dict()
+    for job_id, spec in specs.items():
+        meta = spec.get('Job').get('Meta') or dict()
+        listed = declared.get(job_id, [])
+        if not isinstance(listed, list) or not all(isinstance(each, str) for each in listed):
+            raise Exception('Dependencies of job "{}" in the rollout manifest must be a list of job IDs, found {}'.format(
+                job_id, json.dumps(listed)))
+
+        deps = set(listed)
+        if meta.get('depends_on'):
+            deps.update(each.strip() for each in meta.get('depends_on').split(','))
+        deps.discard('')
+
+        unknown = deps - specs.keys()
+        if unknown:
+            raise Exception('Job "{}" depends on jobs {} which are not part of the rollout'.format(job_id,
+                                                                                                   sorted(unknown)))
+        graph[job_id] = deps
+
+    ordered = set()
+    remaining = dict(graph)
+    while remaining:
+        ready = [job_id for job_id, deps in remaining.items() if deps <= ordered]
+        if not ready:
+            raise Exception('Circular dependency between jobs {}'.format(sorted(remaining.keys())))
+
+        for job_id in ready:
+            ordered.add(job_id)
+            del remaining[job_id]
+
+    return graph
+
+
+def _evaluation_complete(evaluation):
+    status = evaluation.get('Status')
+    if status in ['failed', 'canceled']:
+        raise Exception('Evaluation {} finished with status "{}"'.format(evaluation.get('ID'), status))
+
+    return status == 'complete'
+
+
+def _allocations_complete(client, evaluation):
+    failures = evaluation.get('FailedTGAllocs') or dict()
+    if failures.keys():
+        raise Exception('Failed to place allocations: ' + json.dumps(failures, indent=2))
+
+    for allocation in client(action='get_eval_allocations', evaluation_id=evaluation.get('ID')):
+        client_status = allocation.get('ClientStatus')
+        if client_status in ['failed', 'lost']:
+            raise Exception('Allocation {} finished with status "{}"'.format(allocation.get('ID'), client_status))
+
+        if client_status != 'complete':
+            logger('Allocation {} is {}'.format(allocation.get('ID'), client_status))
+            return False
+
+    return True
+
+
+def _rollout_progress(client, spec, evaluation):
+    state = dict(evaluation=evaluation, evaluated=False)
+
+    def _ready():
+        # The deployment is only known once the scheduler has processed the evaluation
+        if not state['evaluated']:
+            if not _evaluation_complete(state['evaluation']):
+                state['evaluation'] = client(action='get_eval', evaluation_id=state['evaluation'].get('ID'))
+                return False
+            state['evaluated'] = True
+
+        deployment_id = state['evaluation'].get('DeploymentID')
+        if deployment_id is not None and deployment_id != "":
+            return _allocations_placed(client, deployment_id)
+
+        # Batch jobs never create a deployment, they are done once all of their allocations complete
+        if spec.get('Job').get('Type') == 'batch':
+            return _allocations_complete(client, state['evaluation'])
+
+        logger('Job {} has no deployment to wait for'.format(spec.get('Job').get('ID')))
+        return True
+
+    return _ready
+
+
+def _start_rollout_job(client, spec, target_task, container_tag):
+    modification_index = _plan_deployment(client, spec)
+    update_active_ref = _get_promotion_cb(client, spec, target_task, container_tag)
+
+    evaluation = _queue_evaluation(client, spec.get('Job'), modification_index)
+    if evaluation is None:
+        return None
+
+    return _rollout_progress(client, spec, evaluation), update_active_ref
+
+
+def _job_placed(job_id, placed):
+    try:
+        return placed()
+    except Exception:
+        print('Rollout of job "{}" failed'.format(job_id), flush=True)
+        raise
+
+
+def _schedule_rollout(client, specs, graph, target_task, container_tag):
+    pending = dict(graph)
+    running = dict()
+    done = set()
+
+    while pending or running:
+        ready = sorted(job_id for job_id, deps in pending.items() if deps <= done)
+        for job_id in ready:
+            del pending[job_id]
+            print('Starting rollout of job "{}"'.format(job_id), flush=True)
+            placement = _start_rollout_job(client, specs[job_id], target_task, container_tag)
+            if placement is None:
+                print('Job "{}" is registered, it has no evaluation to wait for'.format(job_id), flush=True)
+                done.add(job_id)
+            else:
+                running[job_id] = placement
+
+        # Jobs with nothing to wait for finish immediately and may have unblocked others
+        if ready:
+            continue
+
+        finished = [job_id for job_id in sorted(running) if _job_placed(job_id, running[job_id][0])]
+        for job_id in finished:
+            _, update_active_ref = running.pop(job_id)
+            update_active_ref()
+            done.add(job_id)
+            print('Rollout of job "{}" is complete'.format(job_id), flush=True)
+
+        if running and not finished:
+            print('Waiting for jobs {} to be ready...'.format(', '.join(sorted(running))), flush=True)
+            time.sleep(0 if _replaying() else 10)
+
+
+def rollout(target_env, target_jobs, target_task, container_tag, lambda_func, dynamodb_table, commit_id,
+            build_number, account_number, local_account, region, ci_role, dc, manifest):
+    session_name_prefix = 'drone-{}-{}'.format(commit_id[:8], build_number)
+
+    for target_job in target_jobs:
+        _ensure_job_file(target_job)
+
+    local_arn = 'arn:aws:iam::{}:role/{}'.format(local_account, ci_role)
+    target_arn = 'arn:aws:iam::{}:role/{}'.format(account_number, ci_role)
+    lambda_client = _get_lambda_client(lambda_func, target_arn, region, session_name_prefix)
+    dynamodb_table = _get_dynamodb_table(dynamodb_table, local_arn, region, session_name_prefix)
+
+    specs = dict()
+    for target_job in target_jobs:
+        spec = _process_job_overrides(dynamo=dynamodb_table,
+                                      base_spec=_load_job_spec(target_job),
+                                      env=target_env,
+                                      tag=container_tag,
+                                      task=target_task,
+                                      dc=dc)
+        job_id = spec.get('Job').get('ID')
+        if job_id in specs:
+            raise Exception('Job "{}" is defined more than once in the rollout'.format(job_id))
+        specs[job_id] = spec
+
+        logger('Final job specification')
+        logger(json.dumps(spec, indent=2))
+
+    graph = _rollout_dependencies(specs, manifest)
+    _schedule_rollout(lambda_client, specs, graph, target_task, container_tag)
+    print('All jobs are rolled out, you can promote the deployments now', flush=True)
+
+
 def _latest_deployment_id(client, job_id):
     deployment = client(action='get_last_deployment', job_id=job_id)
     return deployment['ID']
@@ -402,8 +708,7 @@ def _latest_deployment_id(client, job_id):
 
 def promote_allocations(target_job, lambda_func, account_number, region, ci_role, commit_id, build_number):
     session_name_prefix = 'drone-{}-{}'.format(commit_id[:8], build_number)
-    if not path.exists('{}.nomad'.format(target_job)):
-        raise Exception('Unknown target job {}. Expecting file "{}.nomad" to exist'.format(target_job, target_job))
+    _ensure_job_file(target_job)
 
     target_arn = 'arn:aws:iam::{}:role/{}'.format(account_number, ci_role)
     lambda_client = _get_lambda_client(lambda_func, target_arn, region, session_name_prefix)
@@ -417,6 +722,25 @@ def promote_allocations(target_job, lambda_func, account_number, region, ci_role
     _on_placements_ready(lambda_client, deployment_id, _promote)
 
 
+def _profiled(fn):
+    if profile_hook is not None:
+        import importlib
+        module, name = profile_hook.split(':')
+        return getattr(importlib.import_module(module), name)(fn)
+
+    if profile_output is None:
+        return fn()
+
+    import cProfile
+    import pstats
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(fn)
+    finally:
+        profiler.dump_stats(profile_output)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(30)
+
+
 def get_logger(verbose):
     def _l(msg):
         if verbose:
@@ -428,12 +752,15 @@ def get_logger(verbose):
 _actions = {
     'create': place_allocations,
     'promote': promote_allocations,
+    'plan_many': plan_many,
+    'rollout': rollout,
 }
 
 if __name__ == '__main__':
     import os
 
-    config = build_config()
+    session = open_session(record_session, replay_session)
+    config = _recorded('config', build_config)()
 
     logger = get_logger(config['verbose'])
     logger('Configuration:')
@@ -445,4 +772,4 @@ if __name__ == '__main__':
     action = config.get('action')
     del config['action']
 
-    _actions[action](**config)
+    _profiled(lambda: _actions[action](**config))
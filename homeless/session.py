@@ -0,0 +1,92 @@
+import json
+import time
+import decimal
+import threading
+from collections import defaultdict, deque
+
+
+def _encode(obj):
+    if isinstance(obj, decimal.Decimal):
+        return int(obj) if obj % 1 == 0 else float(obj)
+    if isinstance(obj, bytes):
+        return obj.decode()
+
+    raise TypeError('Object of type {} can not be recorded'.format(type(obj).__name__))
+
+
+def _call_key(kind, request):
+    return '{}:{}'.format(kind, json.dumps(request, sort_keys=True, default=_encode))
+
+
+class Recorder(object):
+    replaying = False
+
+    def __init__(self, session_file):
+        self._session_file = session_file
+        self._lock = threading.Lock()
+        open(self._session_file, 'w').close()
+
+    def wrap(self, kind, fn):
+        def _recorded(**kwargs):
+            started = time.time()
+            try:
+                response = fn(**kwargs)
+            except Exception as e:
+                self._save(kind, kwargs, time.time() - started, error=str(e))
+                raise
+
+            self._save(kind, kwargs, time.time() - started, response=response)
+            return response
+
+        return _recorded
+
+    def _save(self, kind, request, elapsed, response=None, error=None):
+        # One call per line so that the session survives a failed or interrupted run
+        line = json.dumps(dict(kind=kind, request=request, response=response, error=error, elapsed=elapsed),
+                          default=_encode)
+        with self._lock:
+            with open(self._session_file, 'a') as f:
+                f.write(line + '\n')
+
+
+class Replayer(object):
+    replaying = True
+
+    def __init__(self, session_file):
+        self._calls = defaultdict(deque)
+        self._lock = threading.Lock()
+        with open(session_file) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+
+                call = json.loads(line)
+                self._calls[_call_key(call['kind'], call['request'])].append(call)
+
+    def wrap(self, kind, fn=None):
+        def _replayed(**kwargs):
+            key = _call_key(kind, kwargs)
+            with self._lock:
+                if not self._calls[key]:
+                    raise Exception('No recorded response left for {} call {}'.format(kind, key))
+                call = self._calls[key].popleft()
+
+            if call.get('error') is not None:
+                raise Exception(call['error'])
+
+            return call['response']
+
+        return _replayed
+
+
+def open_session(record_file, replay_file):
+    if record_file is not None and replay_file is not None:
+        raise Exception('Sessions can either be recorded or replayed, not both')
+
+    if record_file is not None:
+        return Recorder(record_file)
+
+    if replay_file is not None:
+        return Replayer(replay_file)
+
+    return None